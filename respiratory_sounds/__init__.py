@@ -1,5 +1,7 @@
+import functools
 import os
 
+import numpy as np
 import pandas as pd
 
 import respiratory_sounds._patients
@@ -47,40 +49,169 @@ def get_diagnosis_classes():
     return range(num_classes())
 
 
-def load_data_frame_with_cache(data_frame_loader, cache_path):
-    cache_path_head = os.path.dirname(cache_path)
-    if os.path.isfile(cache_path):
-        return pd.read_pickle(cache_path)
-    else:
-        recording_data = data_frame_loader()
-        _tools.create_path_if_nonexistent(cache_path_head)
-        pd.to_pickle(recording_data, cache_path)  # cache for later
-        return recording_data
+def load_data_frame_with_cache(data_frame_loader, cache_path, index=None):
+    """
+    Loads a DataFrame from the Feather file cache_path, creating it with data_frame_loader if it doesn't exist
+
+    Args:
+        data_frame_loader: Function returning the DataFrame
+        cache_path: Path of the cache
+        index: Name of the index of the DataFrame, if any. Feather only stores columns, so the index is
+            cached as a column and restored when loading.
+
+    Returns:
+        DataFrame
+
+    """
+    try:
+        with open(cache_path, 'rb') as cache_file:
+            data_frame = pd.read_feather(cache_file)
+        return data_frame.set_index(index) if index is not None else data_frame
+    except FileNotFoundError:
+        pass  # not cached yet
+    data_frame = data_frame_loader()
+    _tools.create_path_if_nonexistent(os.path.dirname(cache_path))
+    (data_frame.reset_index() if index is not None else data_frame).to_feather(cache_path)  # cache for later
+    return data_frame
+
+
+def _read_recordings_cache(cache_path, audio_cache_path, audio_offsets_cache_path):
+    with open(cache_path, 'rb') as cache_file:
+        recordings = pd.read_feather(cache_file)
+    audio = _recordings.AudioColumn.load(audio_cache_path, audio_offsets_cache_path)
+    recordings.insert(recordings.columns.get_loc("sample_rate"), "audio_recording", list(audio))
+    return recordings, audio
+
+
+def _write_recordings_cache(recordings_loader, cache_path, audio_cache_path, audio_offsets_cache_path):
+    recordings = recordings_loader()
+    # take the audio out of the DataFrame, so save_arrays holds the only reference to each recording
+    audio_recordings = recordings.pop("audio_recording").to_numpy(dtype=object, copy=True)
+    _tools.create_path_if_nonexistent(os.path.dirname(cache_path))
+    recordings.to_feather(cache_path)
+    del recordings
+    _recordings.AudioColumn.save_arrays(audio_recordings, audio_cache_path, audio_offsets_cache_path)
+
+
+def load_recordings_with_cache(recordings_loader, cache_path, audio_cache_path, audio_offsets_cache_path):
+    """
+    Like load_data_frame_with_cache, but keeps the audio out of the metadata cache
+
+    The metadata columns are cached as Feather in cache_path. The audio of all recordings is cached as an
+    AudioColumn: one float32 array saved to audio_cache_path, and the start of each recording in it,
+    plus the end of the last, saved to audio_offsets_cache_path.
+
+    The audio cache is memory-mapped, so each audio_recording is a view into the file that is only read
+    from disk when it is accessed.
+
+    Args:
+        recordings_loader: Function returning the recordings DataFrame
+        cache_path: Path of the metadata cache
+        audio_cache_path: Path of the audio cache
+        audio_offsets_cache_path: Path of the audio offsets cache
+
+    Returns:
+        DataFrame of recordings
+
+    """
+    try:
+        return _read_recordings_cache(cache_path, audio_cache_path, audio_offsets_cache_path)[0]
+    except FileNotFoundError:
+        pass  # not cached yet
+    # the cache is read back, so the decoded audio needn't stay in memory
+    _write_recordings_cache(recordings_loader, cache_path, audio_cache_path, audio_offsets_cache_path)
+    return _read_recordings_cache(cache_path, audio_cache_path, audio_offsets_cache_path)[0]
+
+
+@functools.lru_cache(maxsize=1)
+def _read_all_recordings_cache():
+    # lru_cache doesn't keep exceptions, so this keeps raising FileNotFoundError until the cache is built
+    return _read_recordings_cache(_cache_path_recordings, _cache_path_recording_audio,
+                                  _cache_path_recording_audio_offsets)
+
+
+def _load_all_recordings():
+    """
+    Loads all recordings and their audio, building the recordings cache if it doesn't exist yet
 
+    The cache is read, and its audio memory-mapped, once; later calls return the same objects.
 
-def load_recordings():
-    return _recordings
+    Returns:
+        Tuple of the DataFrame of recordings and the AudioColumn its audio_recording views are taken from
+    """
+    try:
+        return _read_all_recordings_cache()
+    except FileNotFoundError:
+        pass  # not cached yet
+    _write_recordings_cache(_recordings.load_recordings, _cache_path_recordings, _cache_path_recording_audio,
+                            _cache_path_recording_audio_offsets)
+    return _read_all_recordings_cache()
+
+
+def load_recordings(filter_fn=None):
+    """
+    Loads the recordings, or only those selected by filter_fn
+
+    Without filter_fn, all recordings are loaded, building the recordings cache if it doesn't exist yet.
+    With filter_fn, recordings are selected from the cache if it exists; otherwise only the selected
+    recordings are decoded, and nothing is cached.
 
+    Args:
+        filter_fn: Optional function taking a DataFrame of the recordings' meta information
+            ("recording_id", "patient_number", "recording_index", "chest_location", "num_channels",
+            "recording_equipment") and returning a boolean mask of the recordings to load,
+            e.g. lambda df: df.recording_equipment == 'AKGC417L'
+
+    Returns:
+        DataFrame of recordings
+
+    """
+    if filter_fn is None:
+        return _load_all_recordings()[0]
+    try:
+        recordings, _ = _read_all_recordings_cache()
+    except FileNotFoundError:
+        return _recordings.load_recordings(filter_fn)
+    mask = np.asarray(filter_fn(recordings.drop(columns=["audio_recording", "sample_rate"])), dtype=bool)
+    return recordings[mask].reset_index(drop=True)
 
+
+def load_recording_audio():
+    """
+    Loads the audio of all recordings as one contiguous, memory-mapped AudioColumn
+
+    Recording i of the AudioColumn is the audio_recording of the row with recording_id i in load_recordings().
+
+    Returns:
+        AudioColumn of all recordings
+
+    """
+    return _load_all_recordings()[1]
+
+
+@functools.lru_cache(maxsize=1)
 def load_patients():
-    return _patients
+    return load_data_frame_with_cache(_patients.load_patients, _cache_path_patients, index="patient_number")
 
 
 def get_recordings_patients_join():
-    join_field = "patient_number"
-    return pd.merge(left=_recordings, right=_patients, left_on=join_field, right_on=join_field)
+    # patients are indexed by patient_number
+    return load_recordings().join(load_patients(), on="patient_number", how="inner")
 
 
 def empty_cache_recordings():
+    _read_all_recordings_cache.cache_clear()
     os.remove(_cache_path_recordings)
+    os.remove(_cache_path_recording_audio)
+    os.remove(_cache_path_recording_audio_offsets)
 
 
 def empty_cache_patients():
+    load_patients.cache_clear()
     os.remove(_cache_path_patients)
 
 
-_cache_path_recordings = os.path.join(_tools.get_temporary_dir(), '_all_recording_data.pkl')
-_cache_path_patients = os.path.join(_tools.get_temporary_dir(), '_all_patient_data.pkl')
-
-_recordings = load_data_frame_with_cache(_recordings.load_recordings, _cache_path_recordings)
-_patients = load_data_frame_with_cache(_patients.load_patients, _cache_path_patients)
+_cache_path_recordings = os.path.join(_tools.get_temporary_dir(), '_all_recording_data.feather')
+_cache_path_recording_audio = os.path.join(_tools.get_temporary_dir(), '_all_recording_audio.npy')
+_cache_path_recording_audio_offsets = os.path.join(_tools.get_temporary_dir(), '_all_recording_audio_offsets.npy')
+_cache_path_patients = os.path.join(_tools.get_temporary_dir(), '_all_patient_data.feather')
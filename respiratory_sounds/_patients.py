@@ -1,5 +1,5 @@
 import os
-from collections import Mapping, namedtuple
+from collections import namedtuple
 
 import pandas as pd
 
@@ -31,20 +31,20 @@ def _load_demographic_information():
       - Child Height (cm)
 
     Returns:
-        Dictionary of patient_number: Patient
-            where Patient = namedtuple('Patient',
-                                        ("patient_number", "age", "sex", "adult_bmi", "child_weight", "adult_height"))
+        DataFrame with columns:
+            ("patient_number", "age", "sex", "adult_bmi", "child_weight", "child_height")
     """
-    patient_info = []
-    f = open(_get_demographic_info_file_path())
-    for line in f:
-        fields = line.strip().split()
-        assert len(fields) == 6
-        patient_info.append(Patient(*fields))  # uses splat operator to unpack 'fields' list to arguments
-    f.close()
-    df = pd.DataFrame(patient_info)
-    df['patient_number'] = pd.to_numeric(df['patient_number'])
-    return df
+    return pd.read_csv(
+        _get_demographic_info_file_path(), sep=r'\s+', header=None, names=Patient._fields, engine='c',
+        na_values=['NA'], dtype={
+            "patient_number": "int32",
+            "age": "float32",
+            "sex": "category",
+            "adult_bmi": "float32",
+            "child_weight": "float32",
+            "child_height": "float32",
+        }
+    )
 
 
 def _load_patient_diagnoses():
@@ -55,10 +55,11 @@ def _load_patient_diagnoses():
         Panda Data frame of patient diagnoses
     """
     patient_diagnoses = pd.read_csv(
-        _get_patient_diagnoses_csv_path(), header=None, names=["patient_number", "diagnosis_class"]
+        _get_patient_diagnoses_csv_path(), header=None, names=["patient_number", "diagnosis_class"],
+        dtype={"patient_number": "int32"}
     )
     patient_diagnoses['diagnosis_class'] = patient_diagnoses['diagnosis_class'].map(
-        _tools.convert_diagnosis_name_to_class)
+        _tools._NAME_TO_CLASS).astype('int8')
     return patient_diagnoses
 
 
@@ -66,5 +67,5 @@ def load_patients():
     join_field = "patient_number"
     patient_demographics = _load_demographic_information()
     patient_diagnoses = _load_patient_diagnoses()
-    return pd.merge(left=patient_diagnoses, right=patient_demographics, left_on=join_field,
-                    right_on=join_field).set_index(join_field)
+    return patient_diagnoses.join(patient_demographics.set_index(join_field), on=join_field,
+                                  how="inner").set_index(join_field)
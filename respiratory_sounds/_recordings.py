@@ -1,14 +1,18 @@
+import operator
 import os
+import posixpath
 import urllib
 import zipfile
 from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
-from typing import List, Tuple, Any
+from typing import List, Sequence, Tuple, Any
 from urllib.parse import urlparse
 from urllib.request import urlretrieve
 
-import librosa
+import numpy as np
 import pandas as pd
+import soundfile
 
 from respiratory_sounds import _tools
 
@@ -17,6 +21,150 @@ RecordingMetaInfo = namedtuple('RecordingMetaInfo',
                                 "recording_equipment"))
 
 
+class AudioColumn:
+    """
+    Audio of many (mono) recordings stored contiguously
+
+    All samples live in one flat float32 array, blob, and recording i is blob[offsets[i]:offsets[i + 1]].
+    Indexing returns that slice as a view, without copying, and whole-data-set operations can work on
+    blob directly.
+    """
+
+    def __init__(self, blob: np.ndarray, offsets: np.ndarray):
+        """
+        Args:
+            blob: 1-D float32 array of the audio of all recordings, one after the other
+            offsets: 1-D int64 array of the start of each recording in blob, followed by len(blob)
+
+        """
+        assert len(offsets) >= 1 and offsets[0] == 0 and offsets[-1] == len(blob)
+        self.blob = blob
+        self.offsets = offsets
+
+    @classmethod
+    def from_arrays(cls, audio_recordings: Sequence[np.ndarray]) -> 'AudioColumn':
+        """
+        Concatenates the audio of audio_recordings into a new AudioColumn
+
+        Args:
+            audio_recordings: 1-D arrays of audio time series
+
+        Returns:
+            AudioColumn holding a float32 copy of audio_recordings
+
+        Raises:
+            ValueError: If any of audio_recordings is not 1-D
+
+        """
+        offsets = _get_audio_offsets(audio_recordings)
+        # copy straight into the float32 blob, converting on the way, rather than concatenating then converting
+        blob = np.empty(offsets[-1], dtype=np.float32)
+        for audio, start, stop in zip(audio_recordings, offsets[:-1], offsets[1:]):
+            blob[start:stop] = audio
+        return cls(blob, offsets)
+
+    @staticmethod
+    def save_arrays(audio_recordings: np.ndarray, blob_path: str, offsets_path: str):
+        """
+        Saves audio_recordings in the format written by save, releasing each recording once it is written
+
+        Each recording is copied straight into the memory-mapped blob file and its entry in audio_recordings
+        is then set to None, so the audio is never held in memory twice.
+
+        Args:
+            audio_recordings: Object array of 1-D arrays of audio time series, emptied by this call
+            blob_path: Path to save the blob to
+            offsets_path: Path to save the offsets to
+
+        Raises:
+            ValueError: If any of audio_recordings is not 1-D
+
+        """
+        offsets = _get_audio_offsets(audio_recordings)
+        blob = np.lib.format.open_memmap(blob_path, mode='w+', dtype=np.float32, shape=(int(offsets[-1]),))
+        for i, (start, stop) in enumerate(zip(offsets[:-1], offsets[1:])):
+            blob[start:stop] = audio_recordings[i]
+            audio_recordings[i] = None
+        blob.flush()
+        del blob
+        np.save(offsets_path, offsets)
+
+    @classmethod
+    def load(cls, blob_path: str, offsets_path: str) -> 'AudioColumn':
+        """
+        Loads an AudioColumn saved with save, memory-mapping the blob so audio is only read when accessed
+
+        Args:
+            blob_path: Path of the saved blob
+            offsets_path: Path of the saved offsets
+
+        Returns:
+            AudioColumn backed by the file at blob_path
+
+        """
+        return cls(np.load(blob_path, mmap_mode='r'), np.load(offsets_path))
+
+    def save(self, blob_path: str, offsets_path: str):
+        """
+        Saves the blob and offsets as two .npy files
+
+        Args:
+            blob_path: Path to save the blob to
+            offsets_path: Path to save the offsets to
+
+        """
+        np.save(blob_path, self.blob)
+        np.save(offsets_path, self.offsets)
+
+    @property
+    def lengths(self) -> np.ndarray:
+        """Number of samples in each recording"""
+        return np.diff(self.offsets)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        """
+        Args:
+            i: Index of a recording, or a slice (with step 1) of recordings
+
+        Returns:
+            View of the audio of recording i, or an AudioColumn viewing the recordings in slice i
+
+        Raises:
+            IndexError: If i is out of range
+            ValueError: If i is a slice with a step other than 1
+            TypeError: If i is neither an integer nor a slice
+
+        """
+        if isinstance(i, slice):
+            recordings = range(len(self))[i]  # clips the slice to range and resolves negative bounds
+            if recordings.step != 1:
+                raise ValueError("AudioColumn only supports slices with step 1")
+            start, stop = recordings.start, max(recordings.start, recordings.stop)
+            offsets = self.offsets[start:stop + 1]
+            return AudioColumn(self.blob[offsets[0]:offsets[-1]], offsets - offsets[0])
+        try:
+            i = operator.index(i)
+        except TypeError:
+            message = "AudioColumn indices must be integers or slices, not {}".format(type(i).__name__)
+            raise TypeError(message) from None
+        i = range(len(self))[i]  # supports negative indices and raises IndexError when out of range
+        return self.blob[self.offsets[i]:self.offsets[i + 1]]
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+
+def _get_audio_offsets(audio_recordings: Sequence[np.ndarray]) -> np.ndarray:
+    if any(np.ndim(audio) != 1 for audio in audio_recordings):
+        raise ValueError("AudioColumn only holds 1-D (mono) audio recordings")
+    offsets = np.zeros(len(audio_recordings) + 1, dtype=np.int64)
+    np.cumsum([len(audio) for audio in audio_recordings], out=offsets[1:])
+    return offsets
+
+
 def _get_data_set_audio_path():
     return os.path.join(_tools.get_temporary_dir(), 'ICBHI_final_database')
 
@@ -43,12 +191,44 @@ def _get_data_set_from_url(data_set_audio_path, data_set_url):
         members = zip_ref.namelist()
         desired_member = data_set_audio_path_basename + os.path.sep
         assert desired_member in members
-        zip_ref.extractall(path=data_set_audio_path_dirname)
+        _extract_all_concurrently(zip_ref, data_set_audio_path_dirname)
 
     # Delete temp zip file
     # os.remove(temp_data_set_file)
 
 
+def _extract_all_concurrently(zip_ref: zipfile.ZipFile, path: str, max_workers: int = 32):
+    """
+    Extracts all members of zip_ref into path, like ZipFile.extractall but with a pool of threads
+
+    The data set is thousands of small files, so extraction is dominated by per-file I/O which
+    the threads overlap. Members are extracted in the order they are stored in the archive.
+
+    Args:
+        zip_ref: Open ZipFile to extract from
+        path: Directory to extract into
+        max_workers: Number of threads extracting files
+
+    """
+    members = sorted(zip_ref.infolist(), key=lambda member: member.header_offset)
+
+    # Directories, and the first file in each directory, are extracted here so the workers never race to
+    # create the same directory. ZipFile.extract sanitises the member names, so directories are only ever
+    # created inside path.
+    created_dirs = set()
+    files = []
+    for member in members:
+        member_dir = member.filename.rstrip('/') if member.is_dir() else posixpath.dirname(member.filename)
+        if member.is_dir() or member_dir not in created_dirs:
+            zip_ref.extract(member, path=path)
+            created_dirs.add(member_dir)
+        else:
+            files.append(member)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(lambda member: zip_ref.extract(member, path=path), files))
+
+
 def _ensure_data_set_available():
     data_set_audio_path = _get_data_set_audio_path()
     if not os.path.isdir(data_set_audio_path):
@@ -69,109 +249,148 @@ def _is_wav(filename: str) -> bool:
     return filename.lower().endswith(('.wav', '.wave'))
 
 
-def _get_wav_dir_entries() -> List[os.DirEntry]:
+def _get_wav_file_paths_and_stems() -> Tuple[List[str], List[str]]:
     """
-    Gets list of DirEntry files in dataset_audio_path which are wav files
+    Gets the wav files in dataset_audio_path, sorted by file name
+
+    The order doesn't depend on the file system, so recording ids assigned in this order are stable.
 
     Returns:
-        List of DirEntry files
+        Tuple containing:
+            paths: List of file paths
+
+            stems: List of file names without file type at end
 
     """
     _ensure_data_set_available()
     with os.scandir(_get_data_set_audio_path()) as entries:
-        return [entry for entry in entries if _is_wav(entry.name)]
+        wav_files = sorted((entry.name.rsplit('.', 1)[0], entry.path) for entry in entries if _is_wav(entry.name))
+    stems = [stem for stem, _ in wav_files]
+    paths = [path for _, path in wav_files]
+    return paths, stems
 
 
-def _extract_file_name_without_extension_from_path(file_path: str) -> str:
+def _advise_will_need(file_paths: Sequence[str]):
     """
-    Extracts the "naked" file name i.e without path or file type extension
+    Tells the kernel that the files in file_paths will be read soon, so it can start reading them ahead
 
-    Extracts the last part of path and removes the file type (e.g ".wav") from the end
+    Does nothing on platforms without posix_fadvise.
 
     Args:
-        file_path: String of file path
-
-    Returns:
-        String of file name without file type at end
+        file_paths: List of paths to files
 
     """
-    _, file_name = os.path.split(file_path)  # get last part of path (i.e. file name)
-    assert file_name != ""
-    file_name_without_extension = file_name.split('.')
-    assert (len(file_name_without_extension) >= 2)
-    return ".".join(file_name_without_extension[:-1])  # join all but last element into a string, delimited by periods
-
-
-def _get_file_paths(dir_entries):
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    for file_path in file_paths:
+        try:
+            fd = os.open(file_path, os.O_RDONLY)
+        except OSError:
+            continue  # the advice is only a hint, the file will be opened properly later
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+
+
+def _load_recording_datum(file_path: str, prefetch_file_paths: Sequence[str] = ()) -> Tuple[Any, Any]:
     """
-    Takes a list of files as DirEntry objects and returns the file paths
+    Load an audio file from file_path as a float32 time series
 
-    Args:
-        dir_entries: List of DirEntry objects
-
-    Returns:
-        List of file paths as strings
-
-    """
-    return [entry.path for entry in dir_entries]
-
-
-def _load_recording_datum(file_path: str) -> Tuple[Any, Any]:
-    """
-    Load an audio file from file_path as a floating point time series
+    The audio is read at its native sample rate, without resampling. Only mono files are supported,
+    as the recordings are stored one after the other in a flat AudioColumn.
 
     Args:
         file_path: Path to sound file
+        prefetch_file_paths: Paths to sound files that will be loaded next, to be read ahead while
+            file_path is decoded
 
     Returns:
          Tuple containing:
-            audio: np.ndarray [shape=(n,) or (2, n)]
+            audio: np.ndarray [shape=(n,)]
                 audio time series
 
             sample_rate: number > 0 [scalar]
                 sampling rate of `audio`
+
+    Raises:
+        ValueError: If the file has more than one channel
     """
-    audio, sample_rate = librosa.load(file_path, res_type='kaiser_fast')
-    return audio, sample_rate
+    _advise_will_need(prefetch_file_paths)
+    audio, sample_rate = soundfile.read(file_path, dtype='float32', always_2d=False)
+    if audio.ndim != 1:
+        raise ValueError("{} has {} channels, only mono recordings are supported".format(file_path, audio.shape[1]))
+    return audio.astype(np.float32, copy=False), sample_rate
 
 
 def _load_recording_data(wav_file_paths):
     """
     Get all recordings in data set as floating point time series and sample_rates.
 
-    Each recording is a tuple of a floating point time series and the sample_rate.
+    Files are decoded in parallel across a pool of at most one worker process per file, each of which
+    has the kernel read ahead the next few files it will decode. A single file is decoded in-process.
+
+    Args:
+        wav_file_paths: List of paths to wav files
 
     Returns:
-        List of tuples containing:
-            audio: np.ndarray [shape=(n,) or (2, n)]
-                audio time series
+        Tuple containing:
+            audio_recordings: np.ndarray [shape=(len(wav_file_paths),), dtype=object]
+                audio time series of each recording
 
-            sample_rate: number > 0 [scalar]
-                sampling rate of `audio`
+            sample_rates: np.ndarray [shape=(len(wav_file_paths),), dtype=int32]
+                sampling rate of each recording
 
     """
-    return pd.DataFrame(
-        [_load_recording_datum(file_path) for file_path in wav_file_paths],
-        columns=("audio_recording", "sample_rate")
-    )
-
-
-def _extract_meta_info_from_file_name(file_name: str):
+    num_recordings = len(wav_file_paths)
+    audio_recordings = np.empty(num_recordings, dtype=object)
+    sample_rates = np.empty(num_recordings, dtype=np.int32)
+    if num_recordings <= 1:
+        # not worth starting a worker process for
+        for i, file_path in enumerate(wav_file_paths):
+            audio_recordings[i], sample_rates[i] = _load_recording_datum(file_path)
+        return audio_recordings, sample_rates
+
+    num_workers = min(os.cpu_count() or 1, num_recordings)
+    chunk_size = max(1, num_recordings // (4 * num_workers))  # a few chunks per worker evens out the load
+    prefetch_depth = 8
+    # Each worker decodes a contiguous chunk of paths, so the files following a path are the ones it needs next.
+    # The first file of a chunk has the whole window read ahead; after that, only the file entering the window.
+    # Windows stop at the end of the chunk, as the next chunk is decoded, and read ahead, by its own worker.
+    prefetch_file_paths = []
+    for i in range(num_recordings):
+        chunk_end = (i // chunk_size + 1) * chunk_size
+        if i % chunk_size == 0:
+            prefetch_file_paths.append(wav_file_paths[i + 1:min(i + 1 + prefetch_depth, chunk_end)])
+        elif i + prefetch_depth < chunk_end:
+            prefetch_file_paths.append(wav_file_paths[i + prefetch_depth:i + prefetch_depth + 1])
+        else:
+            prefetch_file_paths.append([])
+
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        recording_data = executor.map(_load_recording_datum, wav_file_paths, prefetch_file_paths,
+                                      chunksize=chunk_size)
+        for i, (audio, sample_rate) in enumerate(recording_data):
+            audio_recordings[i] = audio
+            sample_rates[i] = sample_rate
+
+    return audio_recordings, sample_rates
+
+
+def _load_recording_meta_info(wav_file_stems):
     """
-    Extract information about a recording from it's name.
+    Extracts meta information for all recordings from their file names.
 
     Files of recordings are named in a structured way outlined in 'filename_format.txt'
-    in _tools.get_data_set_base_path() but also pasted below.
+    in _tools.get_data_set_base_path(): the file name (without extension) is divided into 5
+    elements, separated with underscores.
 
-    This means the name gives us information about the recording.
-
-    Elements contained in the filenames:
-        Patient number: (101,102,...,226)
+    For each recording sample, there is the following meta information available:
+        Patient number (101,102,...,226)
         Recording index
-        Chest location: (Trachea (Tc), {Anterior (A), Posterior (P), Lateral (L)}{left (l), right (r)})
-        Acquisition mode: (sequential/single channel (sc), simultaneous/multichannel (mc))
-        Recording equipment:
-            (
+        Chest location (Trachea (Tc), {Anterior (A), Posterior (P), Lateral (L)}{left (l), right (r)})
+        Acquisition mode (sequential/single channel (sc), simultaneous/multichannel (mc))
+        Recording equipment (
                 AKG C417L Microphone,
                 3M Littmann Classic II SE Stethoscope,
                 3M Litmmann 3200 Electronic Stethoscope,
@@ -179,57 +398,55 @@ def _extract_meta_info_from_file_name(file_name: str):
             )
 
     Args:
-        file_name: String name of file containing a recording
+        wav_file_stems: List of wav file names without file type at end
 
     Returns:
-        namedtuple('Record',
-                    ("patient_number", "recording_index", "chest_location", "num_channels", "recording_equipment"))
+        DataFrame with columns:
+            ("patient_number", "recording_index", "chest_location", "num_channels", "recording_equipment")
     """
-    record_data_values = file_name.split('_')
+    meta_info = pd.Series(wav_file_stems).str.split('_', expand=True)
+    assert meta_info.shape[1] == len(RecordingMetaInfo._fields)  # for explanation, see docstring
+    meta_info.columns = RecordingMetaInfo._fields
+    meta_info['patient_number'] = meta_info['patient_number'].astype('int32')
     # let sc (single-channel) be represented by an integer 1 and mc (multi-channel) be represented by an integer 2
-    record_data_values[3] = int(1 if record_data_values[3] == "sc" else 2)
-    assert (len(record_data_values) == 5)  # for explanation, see docstring
-    record_data_values[0] = int(record_data_values[0])  # type cast patient_number into int
-    return RecordingMetaInfo(*record_data_values)  # use splat operator to unpack list to arguments
+    meta_info['num_channels'] = np.where(meta_info['num_channels'] == 'sc', 1, 2).astype('int8')
+    for column in ('chest_location', 'recording_equipment'):
+        meta_info[column] = meta_info[column].astype('category')
+    return meta_info
 
 
-def _load_recording_meta_info(wav_file_paths):
+def load_recordings(filter_fn=None):
     """
-    Extracts meta information for all recordings.
+    Loads the recordings in the data set along with their meta information
 
-    For each recording sample, there is the following meta information available:
-        Patient number (101,102,...,226)
-        Recording index
-        Chest location (Trachea (Tc), {Anterior (A), Posterior (P), Lateral (L)}{left (l), right (r)})
-        Acquisition mode (sequential/single channel (sc), simultaneous/multichannel (mc))
-        Recording equipment (
-                AKG C417L Microphone,
-                3M Littmann Classic II SE Stethoscope,
-                3M Litmmann 3200 Electronic Stethoscope,
-                WelchAllyn Meditron Master Elite Electronic Stethoscope
-            )
+    The meta information comes from the file names, so it is available before any audio is decoded;
+    filter_fn selects recordings on it, and only those are decoded.
+
+    Args:
+        filter_fn: Optional function taking a DataFrame of the recordings' meta information
+            ("recording_id", "patient_number", "recording_index", "chest_location", "num_channels",
+            "recording_equipment") and returning a boolean mask of the recordings to load
 
     Returns:
         DataFrame with columns:
-            ("file_path", "patient_number", "recording_index", "chest_location", "num_channels", "recording_equipment")
+            ("recording_id", "patient_number", "recording_index", "chest_location", "num_channels",
+             "recording_equipment", "audio_recording", "sample_rate")
     """
-    return pd.DataFrame(
-        [
-            _extract_meta_info_from_file_name(_extract_file_name_without_extension_from_path(wav_file_path))
-            for wav_file_path in wav_file_paths
-        ]
-    )
-
-
-def load_recordings():
-    wav_file_paths = _get_file_paths(_get_wav_dir_entries())
-    recording_data = _load_recording_data(wav_file_paths)
-    recording_meta_info = _load_recording_meta_info(wav_file_paths)
-    num_recordings = len(recording_data)
-    assert num_recordings == len(recording_data) == len(recording_meta_info)
-    recording_id = pd.Series(range(num_recordings), name="recording_id")
-    return pd.concat([recording_id, recording_meta_info, recording_data], axis=1)
+    wav_file_paths, wav_file_stems = _get_wav_file_paths_and_stems()
+    recordings = _load_recording_meta_info(wav_file_stems)
+    num_recordings = len(wav_file_paths)
+    assert num_recordings == len(recordings)
+    # ids are assigned before filtering, so a recording has the same id whichever recordings are loaded
+    recordings.insert(0, "recording_id", np.arange(num_recordings, dtype=np.int32))
+    if filter_fn is not None:
+        mask = np.asarray(filter_fn(recordings), dtype=bool)
+        recordings = recordings[mask].reset_index(drop=True)
+        wav_file_paths = [path for path, selected in zip(wav_file_paths, mask) if selected]
+    audio_recordings, sample_rates = _load_recording_data(wav_file_paths)
+    recordings["audio_recording"] = audio_recordings
+    recordings["sample_rate"] = sample_rates
+    return recordings
 
 
 if __name__ == '__main__':
-    _get_wav_dir_entries()
\ No newline at end of file
+    _get_wav_file_paths_and_stems()
\ No newline at end of file
@@ -1,4 +1,5 @@
 import os
+from pathlib import Path
 
 
 def get_data_set_base_path():
@@ -13,14 +14,13 @@ def get_temporary_dir():
 
 def create_path_if_nonexistent(path):
     """
-    Ensures existence of a file path by creating it if it doesn't exist
+    Ensures existence of a file path by creating it, and any missing parents, if it doesn't exist
 
     Args:
         path: file path to ensure existence of
 
     """
-    if not os.path.exists(path):
-        os.mkdir(path)
+    Path(path).mkdir(parents=True, exist_ok=True)
 
 
 def diagnosis_class_name_mapping():
@@ -42,6 +42,10 @@ def diagnosis_class_name_mapping():
     ]
 
 
+_CLASS_TO_NAME = diagnosis_class_name_mapping()
+_NAME_TO_CLASS = {name: label for label, name in enumerate(_CLASS_TO_NAME)}
+
+
 def convert_diagnosis_class_to_name(label: int) -> str:
     """
     Converts class label into diagnosis name
@@ -53,7 +57,7 @@ def convert_diagnosis_class_to_name(label: int) -> str:
         String diagnosis
 
     """
-    return diagnosis_class_name_mapping()[label]
+    return _CLASS_TO_NAME[label]
 
 
 def convert_diagnosis_name_to_class(diagnosis: str) -> int:
@@ -67,4 +71,4 @@ def convert_diagnosis_name_to_class(diagnosis: str) -> int:
         Integer label of class
 
     """
-    return diagnosis_class_name_mapping().index(diagnosis)
+    return _NAME_TO_CLASS[diagnosis]
@@ -4,8 +4,10 @@
 from setuptools import setup
 
 reqs=[
-    'pandas==0.25.3',
-    'librosa==0.7.1'
+    'numpy>=1.22',
+    'pandas>=2.0',
+    'pyarrow>=10.0',
+    'soundfile>=0.12'
 ]
 
 setup(